@@ -111,10 +111,7 @@ class GreyRadiationModel(TimeDependentProcess):
         # set diagnostics
         self.do_diagnostics()
         # no tendencies for the parent process
-        tendencies = {}
-        for name, var in self.state.items():
-            tendencies[name] = var * 0.
-        return tendencies
+        return {}
 
     def do_diagnostics(self):
         '''Set all the diagnostics from long and shortwave radiation.'''
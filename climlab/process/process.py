@@ -133,6 +133,9 @@ class Process(object):
     :vartype subprocess:    dict of :class:`~climlab.process.process.Process`
 
     """
+    # Incremented whenever a subprocess is added or removed anywhere, so that
+    #  cached walks through a process tree can detect that they are stale
+    _tree_version = 0
 
     def __str__(self):
         str1 = 'climlab Process of type {0}. \n'.format(type(self))
@@ -272,6 +275,7 @@ class Process(object):
         if isinstance(proc, Process):
             self.subprocess.update({name: proc})
             self.has_process_type_list = False
+            Process._tree_version += 1
             # Add subprocess diagnostics to parent
             #  (if there are no name conflicts)
             for diagname, value in proc.diagnostics.items():
@@ -328,6 +332,7 @@ class Process(object):
             if verbose:
                 print('WARNING: {} not found in subprocess dictionary.'.format(name))
         self.has_process_type_list = False
+        Process._tree_version += 1
 
     def set_state(self, name, value):
         """Sets the variable ``name`` to a new state ``value``.
@@ -3,7 +3,8 @@ from __future__ import print_function
 from builtins import str
 from builtins import range
 import numpy as np
-import copy
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 from climlab import constants as const
 from .process import Process
 from climlab.utils import walk
@@ -37,6 +38,41 @@ def couple(proclist, name='Parent'):
     return coupled
 
 
+@lru_cache(maxsize=32)
+def _days_of_year(timestep_days, days_per_year):
+    """Returns the calendar day at each timestep through one year.
+
+    The result is cached, so processes with the same timestep share a single
+    array. It is therefore made read-only."""
+    days_of_year = np.arange(0., days_per_year, timestep_days)
+    days_of_year.setflags(write=False)
+    return days_of_year
+
+
+def _packed_zeros_like(arrays):
+    """Allocates a single contiguous zero buffer with room for every array
+    in the dictionary ``arrays``.
+
+    Returns the flat buffer and a dictionary of views into it. Each view has
+    the shape and array type (e.g. :class:`~climlab.domain.field.Field`, with
+    its domain) of the corresponding input, so operations on the whole
+    buffer act on all views at once. Note that a scalar input gets a 0-d
+    array view, not a scalar."""
+    values = [np.asanyarray(value) for value in arrays.values()]
+    dtype = np.result_type(*values) if values else float
+    buf = np.zeros(sum(value.size for value in values), dtype=dtype)
+    views = {}
+    offset = 0
+    for name, value in zip(arrays, values):
+        view = buf[offset:offset+value.size].reshape(value.shape)
+        if type(value) is not np.ndarray:
+            view = view.view(type(value))
+            view.__dict__.update(value.__dict__)
+        views[name] = view
+        offset += value.size
+    return buf, views
+
+
 class TimeDependentProcess(Process):
     """A generic parent class for all time-dependent processes.
 
@@ -54,6 +90,9 @@ class TimeDependentProcess(Process):
                             [default: 'explicit']
     :param bool topdown:    whether geneterate *process_types* in regular or
                             in reverse order [default: True]
+    :param bool parallel:   whether subprocesses of the same type should be
+                            computed concurrently in a thread pool
+                            [default: False]
 
     **Object attributes** \n
 
@@ -70,6 +109,19 @@ class TimeDependentProcess(Process):
                             contains all processes and sub-processes) should be
                             generated in regular or in reverse order.
                             See :func:`_build_process_type_list`.
+    :ivar bool parallel:    whether the subprocesses of each type are computed
+                            concurrently. This only pays off if their
+                            ``_compute`` methods spend most of their time in
+                            code that releases the GIL (e.g. large numpy
+                            operations or compiled radiation codes), and
+                            requires that they do not depend on each other
+                            within one timestep. A subprocess that has any
+                            implicit or adjustment process below it
+                            temporarily writes to the state arrays it shares
+                            with its siblings during its ``compute``, so such
+                            subprocesses are always computed on their own,
+                            after the concurrent ones have finished.
+                            See :func:`_compute_type`.
     :ivar dict timeave:     a time averaged collection of all states and diagnostic
                             processes over the timeperiod that
                             :func:`integrate_years` has been called for last.
@@ -88,14 +140,19 @@ class TimeDependentProcess(Process):
         * ``'days_elapsed'``: time counter for days
         * ``'years_elapsed'``: time counter for years
         * ``'days_of_year'``: array which holds the number of numerical steps per year, expressed in days
+          (read-only, shared between processes with the same timestep)
 
     """
-    def __init__(self, time_type='explicit', timestep=None, topdown=True, **kwargs):
+    def __init__(self, time_type='explicit', timestep=None, topdown=True,
+                 parallel=False, **kwargs):
         # Create the state dataset
         self.tendencies = {}
+        self._state_items = ()
+        self._tend_bufs = None
+        self._tend_views = None
         super(TimeDependentProcess, self).__init__(**kwargs)
         for name, var in self.state.items():
-            self.tendencies[name] = var * 0.
+            self.tendencies[name] = np.zeros_like(var)
         self.timeave = {}
         if timestep is None:
             self.set_timestep()
@@ -103,12 +160,28 @@ class TimeDependentProcess(Process):
             self.set_timestep(timestep=timestep)
         self.time_type = time_type
         self.topdown = topdown
+        self.parallel = parallel
+        self._executor = None
+        self._concurrent_safe = None
+        self._concurrent_safe_version = None
         self.has_process_type_list = False
+        self._proc_walk_cache = None
+        self._proc_walk_version = None
 
     def __add__(self, other):
         newparent = couple([self,other])
         return newparent
 
+    def __getstate__(self):
+        #  Copies (e.g. from process_like) would not preserve the views
+        #  into the tendency buffers, so let them be rebuilt on first use.
+        #  A thread pool cannot be copied at all.
+        state = self.__dict__.copy()
+        state['_tend_bufs'] = None
+        state['_tend_views'] = None
+        state['_executor'] = None
+        return state
+
     @property
     def timestep(self):
         """The amount of time over which :func:`step_forward` is integrating in unit seconds.
@@ -123,7 +196,7 @@ class TimeDependentProcess(Process):
     def timestep(self, value):
         num_steps_per_year = const.seconds_per_year / value
         timestep_days = value / const.seconds_per_day
-        days_of_year = np.arange(0., const.days_per_year, timestep_days)
+        days_of_year = _days_of_year(timestep_days, const.days_per_year)
         self.time = {'timestep': value,
                      'num_steps_per_year': num_steps_per_year,
                      'day_of_year_index': 0,
@@ -132,12 +205,30 @@ class TimeDependentProcess(Process):
                      'years_elapsed': 0,
                      'days_of_year': days_of_year,
                      'active_now': True}
+        self._cache_time_scalars()
         self.param['timestep'] = value
 
+    def _cache_time_scalars(self):
+        """Derives the scalars used by :func:`_update_time` at every step
+        from ``self.time['timestep']`` and ``self.time['num_steps_per_year']``.
+
+        They are remembered together with the values they were derived from,
+        so that :func:`_update_time` can rederive them if the ``time``
+        dictionary has been replaced or edited."""
+        time = self.time
+        self._time_scalars_key = (time['timestep'], time['num_steps_per_year'])
+        self._timestep_days = time['timestep'] / const.seconds_per_day
+        #  day_of_year_index is an integer, so comparing it against the
+        #  ceiling of num_steps_per_year-1 is the same as against the float
+        self._last_day_of_year_index = int(np.ceil(time['num_steps_per_year'] - 1))
+
     def set_state(self, name, value):
         super(TimeDependentProcess, self).set_state(name,value)
         # Make sure that the new state variable is added to the tendencies dict
-        self.tendencies[name] = value * 0.
+        self.tendencies[name] = np.zeros_like(self.state[name])
+        # (name, array) pairs iterated by the time-stepping methods
+        self._state_items = tuple(self.state.items())
+        self._tend_bufs = None
 
     def set_timestep(self, timestep=const.seconds_per_day, num_steps_per_year=None):
         """Calculates the timestep in unit seconds
@@ -177,7 +268,8 @@ class TimeDependentProcess(Process):
         all instantaneous adjustments are computed.
 
         Then the changes that were made to the states from explicit and implicit
-        processes are removed again as this
+        processes are removed again, by restoring a copy of the states taken
+        beforehand, as this
         :class:`~climlab.process.time_dependent_process.TimeDependentProcess.compute()`
         function is supposed to calculate only tendencies and not apply them
         to the states.
@@ -203,34 +295,54 @@ class TimeDependentProcess(Process):
                                 after computation of tendencies.
 
         """
-        #  First reset tendencies to zero -- recomputing them is the point of this method
-        for varname in self.tendencies:
-            self.tendencies[varname] *= 0.
         if not self.has_process_type_list:
             self._build_process_type_list()
+        if self._tend_bufs is None:
+            self._build_tendency_buffers()
+        dt = self.timestep
         tendencies = {}
         ignored = self._compute_type('diagnostic')
         tendencies['explicit'] = self._compute_type('explicit')
         #  Tendencies due to implicit and adjustment processes need to be
         #  calculated from a state that is already adjusted after explicit stuff
-        #  So apply the tendencies temporarily and then remove them again
-        for name, var in self.state.items():
-            var += tendencies['explicit'][name] * self.timestep
+        #  So apply the tendencies temporarily and then restore the state
+        #  (not needed at all if there are no such processes)
+        nonempty = self._nonempty_types
+        apply_tendencies = nonempty['implicit'] or nonempty['adjustment']
+        state_backup = self._state_backup
+        scratch = self._state_scratch
+        if apply_tendencies:
+            for name, var in self._state_items:
+                np.copyto(state_backup[name], var)
+                np.multiply(tendencies['explicit'][name], dt, out=scratch[name])
+                np.add(var, scratch[name], out=var)
         # Now compute all implicit processes -- matrix inversions
         tendencies['implicit'] = self._compute_type('implicit')
         #  Same deal ... temporarily apply tendencies from implicit step
-        for name, var in self.state.items():
-            var += tendencies['implicit'][name] * self.timestep
+        if nonempty['implicit'] and nonempty['adjustment']:
+            for name, var in self._state_items:
+                np.multiply(tendencies['implicit'][name], dt, out=scratch[name])
+                np.add(var, scratch[name], out=var)
         # Finally compute all instantaneous adjustments -- expressed as explicit forward step
         tendencies['adjustment'] = self._compute_type('adjustment')
-        #  Now remove the changes from the model state
-        for name, var in self.state.items():
-            var -= ( (tendencies['implicit'][name] + tendencies['explicit'][name]) *
-                    self.timestep)
-        #  Sum up all subprocess tendencies
-        for proctype in ['explicit', 'implicit', 'adjustment']:
-            for varname, tend in tendencies[proctype].items():
-                self.tendencies[varname] += tend
+        #  Now put back the model state exactly as it was
+        if apply_tendencies:
+            for name, var in self._state_items:
+                np.copyto(var, state_backup[name])
+        #  Sum up all subprocess tendencies, each type held in one contiguous
+        #  buffer (this overwrites the tendencies from the previous call).
+        #  Types without processes contribute zeros and are left out.
+        total = self._tend_bufs['total']
+        summed = [self._tend_bufs[proctype] for proctype in
+                  ['explicit', 'implicit', 'adjustment'] if nonempty[proctype]]
+        if not summed:
+            total.fill(0.)
+        elif len(summed) == 1:
+            np.copyto(total, summed[0])
+        else:
+            np.add(summed[0], summed[1], out=total)
+            for buf in summed[2:]:
+                np.add(total, buf, out=total)
         # Finally compute my own tendencies, if any
         self_tend = self._compute()
         #  Adjustment processes _compute method returns absolute adjustment
@@ -244,11 +356,25 @@ class TimeDependentProcess(Process):
 
     def _compute_type(self, proctype):
         """Computes tendencies due to all subprocesses of given type
-        ``'proctype'``. Also pass all diagnostics up to parent process."""
-        tendencies = {}
-        for varname in self.state:
-            tendencies[varname] = 0. * self.state[varname]
-        for proc in self.process_types[proctype]:
+        ``'proctype'``. Also pass all diagnostics up to parent process.
+
+        If ``self.parallel`` is ``True``, the subprocesses that need to be
+        computed at this step and that leave the shared state untouched
+        (see :func:`_modifies_state`) are submitted together to a thread pool
+        owned by this process. The remaining ones are computed one after the
+        other once the pool has finished. Tendencies and diagnostics are
+        still collected in the order of ``self.process_types[proctype]``.
+
+        The returned dictionary holds views into a buffer that is reused
+        (and reset) at the next call for the same ``proctype``."""
+        tendencies = self._tend_views[proctype]
+        if not self._nonempty_types[proctype]:
+            # Buffer is left all zeros by _build_process_type_list
+            return tendencies
+        self._tend_bufs[proctype].fill(0.)
+        procs = self.process_types[proctype]
+        num_active = 0
+        for proc in procs:
             #  Asynchronous coupling
             #  if subprocess has longer timestep than parent
             #  We compute subprocess tendencies once
@@ -256,29 +382,106 @@ class TimeDependentProcess(Process):
             step_ratio = int(proc.timestep / self.timestep)
             #  Does the number of parent steps divide evenly by the ratio?
             #  If so, it's time to do a subprocess step.
-            if self.time['steps'] % step_ratio == 0:
-                proc.time['active_now'] = True
+            proc.time['active_now'] = self.time['steps'] % step_ratio == 0
+            num_active += proc.time['active_now']
+        futures = [None] * len(procs)
+        if self.parallel and num_active > 1:
+            concurrent = [proc.time['active_now'] and
+                          self._concurrent_safe_subprocesses().get(proc, False)
+                          for proc in procs]
+            if sum(concurrent) > 1:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor()
+                futures = [self._executor.submit(proc.compute) if is_concurrent
+                           else None for proc, is_concurrent in zip(procs, concurrent)]
+                #  Subprocesses computed below may write to the shared state,
+                #  so none of the concurrent ones may still be running
+                wait([future for future in futures if future is not None])
+        for proc, future in zip(procs, futures):
+            if future is not None:
+                tenddict = future.result()
+            elif proc.time['active_now']:
                 tenddict = proc.compute()
             else:
                 # proc.tendencies is unchanged from last subprocess timestep if we didn't recompute it above
-                proc.time['active_now'] = False
                 tenddict = proc.tendencies
             for name, tend in tenddict.items():
-                tendencies[name] += tend
+                acc = tendencies[name]
+                np.add(acc, tend, out=acc)
             for diagname, value in proc.diagnostics.items():
                 self.__setattr__(diagname, value)
         return tendencies
 
+    def _modifies_state(self):
+        """Whether :func:`compute` writes to the state arrays of this process.
+
+        This is the case if any process below this one in the tree is of type
+        ``'implicit'`` or ``'adjustment'``, as the explicit (and implicit)
+        tendencies are then temporarily applied to the state, which is shared
+        with the parent and sibling processes."""
+        for name, proc, level in walk.walk_processes(self, ignoreFlag=True):
+            if level > 0 and proc.time_type in ['implicit', 'adjustment']:
+                return True
+        return False
+
+    def _concurrent_safe_subprocesses(self):
+        """Returns a dictionary telling for each subprocess whether it can be
+        computed concurrently with its siblings (see :func:`_modifies_state`).
+
+        The result is cached until a subprocess is added or removed anywhere."""
+        if self._concurrent_safe_version != Process._tree_version:
+            self._concurrent_safe = {proc: not proc._modifies_state()
+                                     for proc in self.subprocess.values()}
+            self._concurrent_safe_version = Process._tree_version
+        return self._concurrent_safe
+
     def _compute(self):
         """Where the tendencies are actually computed...
 
         Needs to be implemented for each daughter class
 
-        Returns a dictionary with same keys as self.state"""
-        tendencies = {}
-        for name, value in self.state.items():
-            tendencies[name] = value * 0.
-        return tendencies
+        Returns a dictionary of tendencies keyed by state variable name.
+        State variables without an entry get no tendency from this process,
+        so the default (e.g. for parent processes that only hold
+        subprocesses) is an empty dictionary."""
+        return {}
+
+    def _build_tendency_buffers(self):
+        """Allocates contiguous buffers for the tendencies of all state
+        variables.
+
+        One flat buffer is created for each process type and one for the
+        total tendencies. The arrays in ``self.tendencies`` and in the
+        dictionaries returned by :func:`_compute_type` are views into these
+        buffers, so they can be reset and summed up with a single numpy
+        operation per buffer instead of allocating new arrays at every call
+        of :func:`compute`.
+
+        Following object attributes are generated or updated:
+
+        :ivar dict _tend_bufs:      flat buffer for each of ``'diagnostic'``,
+                                    ``'explicit'``, ``'implicit'``,
+                                    ``'adjustment'`` and ``'total'``
+        :ivar dict _tend_views:     dictionaries of per-variable views into
+                                    each of these buffers
+        :ivar dict _state_backup:   copy of the state, used by :func:`compute`
+                                    to restore it after temporarily applying
+                                    explicit and implicit tendencies
+        :ivar dict _state_scratch:  state-shaped work arrays holding the
+                                    increments ``tendency * timestep``
+
+        The buffers are rebuilt when a state variable is set with
+        :func:`set_state`.
+
+        """
+        state = dict(self._state_items)
+        self._tend_bufs = {}
+        self._tend_views = {}
+        for key in ['diagnostic', 'explicit', 'implicit', 'adjustment', 'total']:
+            self._tend_bufs[key], self._tend_views[key] = _packed_zeros_like(state)
+        self.tendencies.update(self._tend_views['total'])
+        ignored, self._state_backup = _packed_zeros_like(state)
+        ignored, self._state_scratch = _packed_zeros_like(state)
 
     def _build_process_type_list(self):
         """Generates lists of processes organized by process type.
@@ -290,6 +493,9 @@ class TimeDependentProcess(Process):
                                     ``'implicit'`` and ``'adjustment'`` which
                                     point to a list of processes according to
                                     the process types.
+        :ivar dict _nonempty_types: whether there is any process of each type,
+                                    so that :func:`compute` can skip the work
+                                    for absent types.
 
         The ``process_types`` dictionary is created while walking
         through the processes with :func:`~climlab.utils.walk.walk_processes`
@@ -302,6 +508,12 @@ class TimeDependentProcess(Process):
         #    self.process_types[proc.time_type].append(proc)
         for name, proc in self.subprocess.items():
             self.process_types[proc.time_type].append(proc)
+        self._nonempty_types = {proctype: len(procs) > 0 for proctype, procs
+                                in self.process_types.items()}
+        #  _compute_type skips empty types, so their tendencies must be zero
+        if self._tend_bufs is not None:
+            for proctype in self.process_types:
+                self._tend_bufs[proctype].fill(0.)
         self.has_process_type_list = True
 
     def step_forward(self):
@@ -333,11 +545,19 @@ class TimeDependentProcess(Process):
         tenddict = self.compute()
         #  Total tendency is applied as an explicit forward timestep
         # (already accounting properly for order of operations in compute() )
-        for varname, tend in tenddict.items():
-            self.state[varname] += tend * self.timestep
+        for varname, var in self._state_items:
+            increment = self._state_scratch[varname]
+            np.multiply(tenddict[varname], self.timestep, out=increment)
+            np.add(var, increment, out=var)
         # Update all time counters for this and all subprocesses in the tree
         #  Also pass diagnostics up the process tree
-        for name, proc, level in walk.walk_processes(self, ignoreFlag=True):
+        #  The tree only changes when subprocesses are added or removed,
+        #  so walk it once and reuse the flat list of processes until then
+        if self._proc_walk_version != Process._tree_version:
+            self._proc_walk_cache = [proc for name, proc, level in
+                                     walk.walk_processes(self, ignoreFlag=True)]
+            self._proc_walk_version = Process._tree_version
+        for proc in self._proc_walk_cache:
             if proc.time['active_now']:
                 proc._update_time()
 
@@ -347,8 +567,20 @@ class TimeDependentProcess(Process):
         subprocess coupling is accounted for. The number of iterations can
         be changed with the input argument.
 
+        Only the last iteration is a full call to compute(). The ones before
+        it evaluate just the diagnostic and explicit subprocesses, through
+        which the coupling via diagnostics happens, and skip the implicit
+        solvers and adjustments, which are evaluated once at the end.
+
         """
-        for n in range(num_iter):
+        if not self.has_process_type_list:
+            self._build_process_type_list()
+        if self._tend_bufs is None:
+            self._build_tendency_buffers()
+        for n in range(num_iter - 1):
+            ignored = self._compute_type('diagnostic')
+            ignored = self._compute_type('explicit')
+        if num_iter > 0:
             ignored = self.compute()
 
     def _update_time(self):
@@ -359,14 +591,23 @@ class TimeDependentProcess(Process):
 
         The function is called by the time stepping methods.
 
+        ``self.time`` is the source of truth: if its ``'timestep'`` or
+        ``'num_steps_per_year'`` no longer match the cached scalars
+        (e.g. because the dictionary was replaced with the one from a model
+        with a different timestep), these are derived again first.
+
         """
-        self.time['steps'] += 1
+        time = self.time
+        if (time['timestep'], time['num_steps_per_year']) != self._time_scalars_key:
+            self._cache_time_scalars()
+        time['steps'] += 1
         # time in days since beginning
-        self.time['days_elapsed'] += self.time['timestep'] / const.seconds_per_day
-        if self.time['day_of_year_index'] >= self.time['num_steps_per_year']-1:
+        time['days_elapsed'] += self._timestep_days
+        day_of_year_index = time['day_of_year_index'] + 1
+        if day_of_year_index > self._last_day_of_year_index:
             self._do_new_calendar_year()
         else:
-            self.time['day_of_year_index'] += 1
+            time['day_of_year_index'] = day_of_year_index
 
     def _do_new_calendar_year(self):
         """This function is called once at the end of every calendar year.
@@ -413,10 +654,20 @@ class TimeDependentProcess(Process):
         if verbose:
             print("Integrating for " + str(numsteps) + " steps, "
                   + str(days) + " days, or " + str(years) + " years.")
+        #  All time-averaging accumulators for arrays live in one contiguous
+        #  buffer, scalars are summed as plain numbers and keep their type
+        timeave_buf = None
+        #  (name, accumulator) pairs for state variables and diagnostics
+        state_accumulators = []
+        diag_accumulators = []
+        #  names of scalar quantities (all of them diagnostics in practice)
+        scalars = []
+        #  look up the bound method once rather than at every step
+        step_forward = self.step_forward
         #  begin time loop
         for count in range(numsteps):
             # Compute the timestep
-            self.step_forward()
+            step_forward()
             if count == 0:
                 # on first step only...
                 #  This implements a generic time-averaging feature
@@ -425,24 +676,40 @@ class TimeDependentProcess(Process):
                 # add any new diagnostics to the timeave dictionary
                 self.timeave.update(self.diagnostics)
                 # reset all values to zero
+                # skipping None values preserves NoneType diagnostics
+                averaged = {}
                 for varname, value in self.timeave.items():
-                # moves on to the next varname if value is None
-                # this preserves NoneType diagnostics
                     if value is None:
                         continue
-                    self.timeave[varname] = 0*value
+                    if np.ndim(value) == 0:
+                        self.timeave[varname] = 0*value
+                        scalars.append(varname)
+                    else:
+                        averaged[varname] = value
+                timeave_buf, views = _packed_zeros_like(averaged)
+                self.timeave.update(views)
+                for varname, acc in views.items():
+                    if varname in self.state:
+                        state_accumulators.append((varname, acc))
+                    else:
+                        diag_accumulators.append((varname, acc))
             # adding up all values for each timestep
-            for varname in list(self.timeave.keys()):
-                try:
-                    self.timeave[varname] += self.state[varname]
-                except:
-                    try:
-                        self.timeave[varname] += self.diagnostics[varname]
-                    except: pass
+            for varname, acc in state_accumulators:
+                np.add(acc, self.state[varname], out=acc)
+            if diag_accumulators or scalars:
+                #  the diagnostics property builds a new dict at each access
+                diagnostics = self.diagnostics
+                for varname, acc in diag_accumulators:
+                    np.add(acc, diagnostics[varname], out=acc)
+                for varname in scalars:
+                    if varname in self.state:
+                        self.timeave[varname] += self.state[varname]
+                    else:
+                        self.timeave[varname] += diagnostics[varname]
         # calculating mean values through dividing the sum by number of steps
-        for varname, value in self.timeave.items():
-            if value is None:
-                continue
+        if timeave_buf is not None:
+            timeave_buf /= numsteps
+        for varname in scalars:
             self.timeave[varname] /= numsteps
         if verbose:
             print("Total elapsed time is %s years."
@@ -507,12 +774,20 @@ class TimeDependentProcess(Process):
 
         """
         # implemented by m-kreuzer
-        for varname, value in self.state.items():
-            value_old = copy.deepcopy(value)
+        #  Integrate one year at a time until no state variable has changed
+        #  by more than crit over the last year.
+        #  The state at the start of each year is saved in one contiguous
+        #  buffer, which is then turned in place into the change over the
+        #  year, so that a single reduction gives the largest change.
+        state_old_buf, state_old = _packed_zeros_like(dict(self._state_items))
+        diff = np.inf
+        while diff > crit:
+            for name, value in self._state_items:
+                np.copyto(state_old[name], value)
             self.integrate_years(1,verbose=False)
-            while np.max(np.abs(value_old-value)) > crit :
-                value_old = copy.deepcopy(value)
-                self.integrate_years(1,verbose=False)
+            for name, value in self._state_items:
+                np.subtract(state_old[name], value, out=state_old[name])
+            diff = np.max(np.abs(state_old_buf), initial=0.)
         if verbose == True:
             print("Total elapsed time is %s years."
                   % str(self.time['days_elapsed']/const.days_per_year))
@@ -132,3 +132,82 @@ def test_moist_EBM_creation():
     m.add_subprocess('diffusion', diff)
     m.step_forward()
     assert hasattr(m, 'heat_transport')
+
+@pytest.mark.fast
+def test_timeave_types(EBM_seasonal):
+    '''Check that time averages keep the type of the averaged quantities:
+    scalars stay scalars and arrays stay Fields with their domain.'''
+    from climlab.domain.field import Field
+    m = EBM_seasonal
+    m.integrate_days(10., verbose=False)
+    assert np.ndim(m.timeave['ice_area']) == 0
+    assert isinstance(m.timeave['ice_area'], np.floating)
+    assert isinstance(m.timeave['Ts'], Field)
+    assert m.timeave['Ts'].domain is m.Ts.domain
+    assert isinstance(m.timeave['OLR'], Field)
+    assert hasattr(m.timeave['OLR'], 'domain')
+
+@pytest.mark.fast
+def test_replace_time():
+    '''Check that the calendar follows a time dictionary taken over from a
+    model with a different timestep.'''
+    a = climlab.EBM()
+    b = climlab.EBM(timestep=climlab.constants.seconds_per_year/30.)
+    assert a.time['num_steps_per_year'] != b.time['num_steps_per_year']
+    a.time = b.time.copy()
+    years = a.time['years_elapsed']
+    for n in range(int(b.time['num_steps_per_year'])):
+        a._update_time()
+    assert a.time['years_elapsed'] == years + 1
+    assert a.time['day_of_year_index'] == 0
+
+@pytest.mark.fast
+def test_days_of_year_shared():
+    '''Check that processes with the same timestep share one read-only
+    days_of_year array.'''
+    a = climlab.EBM()
+    b = climlab.EBM()
+    assert not a.time['days_of_year'].flags.writeable
+    assert a.time['days_of_year'] is b.time['days_of_year']
+
+def _parallel_tree(parallel):
+    """Parent with three explicit subprocesses on a shared state. The first
+    one has an adjustment process below it, so its compute() temporarily
+    writes to the shared state."""
+    from climlab.process import TimeDependentProcess
+    from climlab.radiation import AplusBT
+    state = climlab.surface_state(num_lat=200000)
+    inner = TimeDependentProcess(state=state, name='inner')
+    inner.add_subprocess('LW', AplusBT(state=state))
+    inner.add_subprocess('adj', TimeDependentProcess(state=state,
+                                                     time_type='adjustment'))
+    parent = TimeDependentProcess(state=state, parallel=parallel)
+    parent.add_subprocess('inner', inner)
+    parent.add_subprocess('LW1', AplusBT(state=state))
+    parent.add_subprocess('LW2', AplusBT(state=state))
+    return parent
+
+@pytest.mark.fast
+def test_parallel_subprocesses():
+    '''Check that computing subprocesses in a thread pool gives the same
+    result as computing them one after the other.'''
+    m = climlab.EBM_seasonal()
+    m_parallel = climlab.EBM_seasonal(parallel=True)
+    assert m_parallel.parallel
+    m.integrate_years(1., verbose=False)
+    m_parallel.integrate_years(1., verbose=False)
+    assert m_parallel._executor is not None
+    assert np.allclose(m.Ts, m_parallel.Ts)
+    assert np.allclose(m.timeave['OLR'], m_parallel.timeave['OLR'])
+    #  the thread pool must not prevent copying a process
+    m_copy = climlab.process_like(m_parallel)
+    m_copy.step_forward()
+    #  A subprocess that modifies the shared state within its compute()
+    #  must not run concurrently with its siblings
+    serial = _parallel_tree(parallel=False)
+    concurrent = _parallel_tree(parallel=True)
+    for n in range(10):
+        serial.step_forward()
+        concurrent.step_forward()
+    assert concurrent._executor is not None
+    assert np.array_equal(serial.Ts, concurrent.Ts)
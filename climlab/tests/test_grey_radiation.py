@@ -94,3 +94,25 @@ def test_external_tendency():
     model2.step_forward()
     assert model.tendencies['Tatm'] + temp_tend == pytest.approx(model2.tendencies['Tatm'])
     #assert np.all(np.isclose(model.tendencies['Tatm'] == (model2.tendencies['Tatm']-temp_tend))
+
+@pytest.mark.fast
+def test_integrate_converge():
+    '''Check that integrate_converge stops as soon as every state variable
+    has stopped changing, testing all of them together.'''
+    crit = 1e-4
+    m = climlab.GreyRadiationModel(num_lev=10)
+    assert len(m.state) > 1
+    m.integrate_converge(crit=crit, verbose=False)
+    #  the same criterion, checked jointly in a simple loop
+    ref = climlab.GreyRadiationModel(num_lev=10)
+    while True:
+        old = {name: value.copy() for name, value in ref.state.items()}
+        ref.integrate_years(1, verbose=False)
+        if max(np.max(np.abs(old[name] - value))
+               for name, value in ref.state.items()) <= crit:
+            break
+    assert m.time['years_elapsed'] == ref.time['years_elapsed']
+    old = {name: value.copy() for name, value in m.state.items()}
+    m.integrate_years(1, verbose=False)
+    for name, value in m.state.items():
+        assert np.max(np.abs(value - old[name])) < crit